@@ -1,21 +1,42 @@
+import asyncio
+import hashlib
 import logging
 import os
+import queue
+import re
+import socket
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
 from io import BytesIO
-from uuid import uuid4
-from typing import Optional
+from logging.handlers import QueueHandler, QueueListener
+from typing import Awaitable, Callable, Optional
+from urllib.parse import urlparse
 
+import httpx
+import orjson
+from PIL import Image
 from telegram import Update
+from telegram.constants import ChatAction, MessageLimit
+from telegram.error import TelegramError
 from telegram.ext import (
+    AIORateLimiter,
     Application,
     CommandHandler,
     MessageHandler,
     ContextTypes,
     filters,
 )
+from telegram.request import HTTPXRequest
 
 from google import genai
 from google.genai import types
 
+try:
+    import uvloop
+except ImportError:  # uvloop не собирается под Windows
+    uvloop = None
+
 
 # ----------------- ЛОГИРОВАНИЕ -----------------
 
@@ -26,30 +47,115 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+def start_queue_logging() -> QueueListener:
+    """Логи пишет отдельный поток; logger.* в хендлерах лишь кладёт запись в очередь."""
+    root = logging.getLogger()
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, *root.handlers, respect_handler_level=True)
+    root.handlers = [QueueHandler(log_queue)]
+    listener.start()
+    return listener
+
+
 # ----------------- НАСТРОЙКИ -----------------
 
 ZENMUX_BASE_URL = "https://zenmux.ai/api/vertex-ai"
+ZENMUX_HOST = urlparse(ZENMUX_BASE_URL).hostname
 IMAGE_MODEL_ID = "google/gemini-3-pro-image-preview-free"
 
+# Конфиг запроса не меняется — собираем его один раз, а не на каждый вызов
+IMAGE_GEN_CONFIG = types.GenerateContentConfig(response_modalities=["IMAGE"])
+
 _genai_client: Optional[genai.Client] = None
 
-# Чат владельца бота (опционально)
-OWNER_CHAT_ID = os.getenv("OWNER_CHAT_ID")
+# Память: file_id последней картинки на чат (для "отредактируй..."), LRU;
+# сами байты при необходимости заново скачиваются из Telegram
+LAST_IMAGE_CACHE_SIZE = int(os.getenv("LAST_IMAGE_CACHE", "256"))
+LAST_IMAGE_BY_CHAT: OrderedDict[int, str] = OrderedDict()
+
+# Команды редактирования последней картинки
+EDIT_COMMAND_RE = re.compile(
+    r"^(?:отредактируй|измени картинку|сделай вариацию)", re.IGNORECASE
+)
 
-# Память: последняя картинка на чат (для "отредактируй...")
-LAST_IMAGE_BY_CHAT: dict[int, bytes] = {}
+# Входные картинки ужимаем до этой стороны: меньше трафика и токенов модели
+MAX_INPUT_EDGE = 1024
 
+# Не больше N одновременных запросов к Zenmux, остальные ждут своей очереди
+# (апдейты обрабатываются параллельно — см. concurrent_updates в main())
+GEN_SEM = asyncio.Semaphore(int(os.getenv("GEN_CONCURRENCY", "5")))
+
+# Общий предел на генерацию вместе с повторами на 429/5xx, секунд
+GEN_TIMEOUT = 120
+
+# Как часто обновлять статус "отправляет фото…" в чате, секунд
+UPLOAD_ACTION_INTERVAL = 10
+
+# Кэш "sha256 промпта -> (истекает, file_id в Telegram)" для повторных
+# текстовых запросов (LRU + TTL); по file_id Telegram отдаёт фото без
+# повторной загрузки
+PROMPT_CACHE_SIZE = int(os.getenv("PROMPT_CACHE_SIZE", "1024"))
+PROMPT_CACHE_TTL = int(os.getenv("PROMPT_CACHE_TTL", "3600"))
+PROMPT_CACHE: OrderedDict[str, tuple[float, str]] = OrderedDict()
+
+# Текстовые промпты, которые генерируются прямо сейчас: одинаковые
+# одновременные запросы ждут один и тот же вызов Zenmux
+INFLIGHT: dict[str, "InFlight"] = {}
+
+
+@dataclass(frozen=True, slots=True)
+class Config:
+    """Настройки из окружения, проверенные один раз при старте."""
+
+    telegram_token: str = field(repr=False)
+    webhook_url: str
+    port: int
+    zenmux_api_key: str = field(repr=False)
+    owner_chat_id: Optional[str]  # чат владельца бота (опционально)
+
+
+@dataclass(slots=True)
+class InFlight:
+    """Генерация в INFLIGHT и те, кто к ней присоединился."""
+
+    future: asyncio.Future[bytes]
+    has_slot: bool = False  # ведущий уже получил слот GEN_SEM
+    # on_slot присоединившихся, которые ждут, пока слот получит ведущий
+    waiting: list[Callable[[], None]] = field(default_factory=list)
 
-def get_genai_client() -> genai.Client:
-    """Ленивая инициализация клиента Google GenAI через Zenmux."""
-    global _genai_client
-    if _genai_client is not None:
-        return _genai_client
+
+def load_config() -> Config:
+    token = os.getenv("TELEGRAM_TOKEN")
+    if not token:
+        raise RuntimeError("TELEGRAM_TOKEN не задан")
+
+    base_webhook_url = os.getenv("WEBHOOK_URL")
+    if not base_webhook_url:
+        raise RuntimeError("WEBHOOK_URL не задан (например, https://nanobot-92lp.onrender.com)")
 
     api_key = os.getenv("ZENMUX_API_KEY")
     if not api_key:
         raise RuntimeError("ZENMUX_API_KEY не задан")
 
+    return Config(
+        telegram_token=token,
+        webhook_url=base_webhook_url,
+        port=int(os.getenv("PORT", "8443")),
+        zenmux_api_key=api_key,
+        owner_chat_id=os.getenv("OWNER_CHAT_ID") or None,
+    )
+
+
+def get_genai_client() -> genai.Client:
+    if _genai_client is None:
+        raise RuntimeError("GenAI клиент не инициализирован")
+    return _genai_client
+
+
+def init_genai_client(api_key: str) -> genai.Client:
+    """Инициализация клиента Google GenAI через Zenmux (один раз при старте)."""
+    global _genai_client
+
     logger.info("Инициализирую GenAI клиент %s", ZENMUX_BASE_URL)
 
     _genai_client = genai.Client(
@@ -58,102 +164,242 @@ def get_genai_client() -> genai.Client:
         http_options=types.HttpOptions(
             api_version="v1",
             base_url=ZENMUX_BASE_URL,
+            timeout=GEN_TIMEOUT * 1000,  # мс, на одну попытку
+            # повторы с экспоненциальной паузой и jitter на 429/5xx прямо
+            # на HTTP-уровне SDK
+            retry_options=types.HttpRetryOptions(
+                attempts=3,
+                initial_delay=0.5,
+                max_delay=8,
+                http_status_codes=[429, 500, 502, 503, 504],
+            ),
+            # общий пул keep-alive соединений к zenmux.ai на все запросы бота;
+            # по HTTP/2 одновременные генерации идут по одному соединению
+            async_client_args={
+                "transport": httpx.AsyncHTTPTransport(
+                    http2=True,
+                    limits=httpx.Limits(
+                        max_connections=100,
+                        max_keepalive_connections=50,
+                        keepalive_expiry=30,
+                    ),
+                ),
+            },
         ),
     )
     return _genai_client
 
 
-def _extract_image_from_response(response) -> BytesIO:
-    """Достаём изображение из ответа Gemini (через Zenmux)."""
-    for part in response.parts:
-        if part.inline_data:
-            img = part.as_image()
+def _truncate(text: str, limit: int = 512) -> str:
+    """Обрезаем текст до limit символов вместе с "…" в конце."""
+    return text if len(text) <= limit else text[: limit - 1] + "…"
+
 
-            tmp_path = f"/tmp/zenmux_{uuid4().hex}.png"
-            img.save(tmp_path)  # save ждёт путь, а не BytesIO
+def _downscale_image(image_bytes: bytes) -> bytes:
+    """Уменьшаем картинку до MAX_INPUT_EDGE по большей стороне и пережимаем в JPEG."""
+    with Image.open(BytesIO(image_bytes)) as im:
+        if im.format == "JPEG" and max(im.size) <= MAX_INPUT_EDGE:
+            return image_bytes
 
-            with open(tmp_path, "rb") as f:
-                data = f.read()
+        im.thumbnail((MAX_INPUT_EDGE, MAX_INPUT_EDGE), Image.Resampling.LANCZOS)
+        out = BytesIO()
+        im.convert("RGB").save(out, format="JPEG", quality=88)
+    return out.getvalue()
 
-            buf = BytesIO(data)
-            buf.seek(0)
-            return buf
+
+def _extract_image_from_response(response) -> bytes:
+    """Достаём изображение из ответа Gemini (через Zenmux)."""
+    for part in response.parts:
+        if part.inline_data and part.inline_data.data:
+            # as_image().save() лишь пишет эти же байты в файл — берём их напрямую
+            return part.inline_data.data
 
     raise RuntimeError("API не вернул изображение (inline_data отсутствует)")
 
 
-def generate_image_from_text(prompt: str) -> BytesIO:
-    """Генерация картинки только по тексту."""
+async def request_image(prompt: str, image_bytes: Optional[bytes]) -> bytes:
+    """Один запрос к Zenmux: текст (+ JPEG для вариации) -> картинка."""
     client = get_genai_client()
 
+    contents: list = [prompt]
+    if image_bytes is not None:
+        contents.append(types.Part.from_bytes(data=image_bytes, mime_type="image/jpeg"))
+    kind = "text->image" if image_bytes is None else "image+text->image"
+
     try:
-        response = client.models.generate_content(
+        response = await client.aio.models.generate_content(
             model=IMAGE_MODEL_ID,
-            contents=[prompt],
-            config=types.GenerateContentConfig(
-                response_modalities=["IMAGE"],
-            ),
+            contents=contents,
+            config=IMAGE_GEN_CONFIG,
         )
     except Exception as e:
-        logger.exception("Ошибка Zenmux API (text->image)")
-        raise RuntimeError(f"Ошибка API: {e}")
+        # тело ошибки API бывает огромным — в лог и пользователю идёт начало;
+        # полный стек (с исходной ошибкой httpx) — на уровне DEBUG
+        logger.error("Ошибка Zenmux API (%s): %s", kind, _truncate(repr(e)))
+        logger.debug("Стек ошибки Zenmux API", exc_info=True)
+        raise RuntimeError(f"Ошибка API: {_truncate(str(e))}") from e
 
     return _extract_image_from_response(response)
 
 
-def generate_image_from_image(prompt: str, image_bytes: bytes) -> BytesIO:
-    """Генерация вариации по картинке + тексту."""
-    client = get_genai_client()
+async def generate_image(
+    prompt: str,
+    base_image_bytes: Optional[bytes],
+    on_slot: Optional[Callable[[], None]] = None,
+) -> bytes:
+    """Генерация под семафором GEN_SEM, не дольше GEN_TIMEOUT вместе с повторами.
+
+    on_slot вызывается, когда слот GEN_SEM получен и запрос уходит в Zenmux.
+    """
+    async with GEN_SEM:
+        if on_slot is not None:
+            on_slot()
+        try:
+            return await asyncio.wait_for(
+                request_image(prompt, base_image_bytes), timeout=GEN_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            raise RuntimeError(f"Zenmux не ответил за {GEN_TIMEOUT} с") from None
+
+
+def _lru_get(cache: OrderedDict, key):
+    value = cache.get(key)
+    if value is not None:
+        cache.move_to_end(key)
+    return value
 
-    image_part = types.Part.from_bytes(
-        data=image_bytes,
-        mime_type="image/jpeg",  # фото из Telegram обычно JPEG
-    )
+
+def _lru_put(cache: OrderedDict, key, value, maxsize: int) -> None:
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > maxsize:
+        cache.popitem(last=False)
+
+
+def _prompt_cache_key(prompt: str) -> str:
+    return hashlib.sha256(prompt.strip().lower().encode()).hexdigest()
+
+
+def _prompt_cache_get(key: str) -> Optional[str]:
+    entry = _lru_get(PROMPT_CACHE, key)
+    if entry is None:
+        return None
+    expires_at, file_id = entry
+    if expires_at < time.monotonic():
+        del PROMPT_CACHE[key]
+        return None
+    return file_id
+
+
+def _prompt_cache_put(key: str, file_id: str) -> None:
+    entry = (time.monotonic() + PROMPT_CACHE_TTL, file_id)
+    _lru_put(PROMPT_CACHE, key, entry, PROMPT_CACHE_SIZE)
+
+
+async def generate_image_single_flight(
+    key: str,
+    prompt: str,
+    notify_queued: Optional[Callable[[], Awaitable[None]]] = None,
+    on_slot: Optional[Callable[[], None]] = None,
+) -> tuple[bytes, bool]:
+    """Текстовая генерация, общая для всех одновременных запросов с ключом key.
+
+    Возвращает (картинка, joined): joined=True, если картинку сгенерировал
+    другой запрос. Готовый результат остаётся в INFLIGHT, пока ведущий не
+    положит file_id в PROMPT_CACHE, — запись убирает handle_generation.
+    """
+    entry = INFLIGHT.get(key)
+    if entry is not None:
+        # своего слота GEN_SEM у присоединившегося нет — статус в чате
+        # включаем вместе с ведущим, а не на время его ожидания в очереди
+        if on_slot is not None and not entry.future.done():
+            if entry.has_slot:
+                on_slot()
+            else:
+                entry.waiting.append(on_slot)
+        try:
+            # shield: отмена одного ждущего не должна отменять общий результат
+            return await asyncio.shield(entry.future), True
+        finally:
+            if on_slot in entry.waiting:
+                entry.waiting.remove(on_slot)
+
+    entry = InFlight(asyncio.get_running_loop().create_future())
+    INFLIGHT[key] = entry
+    fut = entry.future
+
+    def slot_acquired() -> None:
+        entry.has_slot = True
+        if on_slot is not None:
+            on_slot()
+        for callback in entry.waiting:
+            callback()
+        entry.waiting.clear()
 
     try:
-        response = client.models.generate_content(
-            model=IMAGE_MODEL_ID,
-            contents=[
-                prompt,
-                image_part,
-            ],
-            config=types.GenerateContentConfig(
-                response_modalities=["IMAGE"],
-            ),
-        )
+        # об очереди сообщает только ведущий и уже после регистрации в
+        # INFLIGHT: одинаковые промпты, пришедшие за этот await, присоединятся
+        if notify_queued is not None:
+            await notify_queued()
+        png_bytes = await generate_image(prompt, None, slot_acquired)
+    except asyncio.CancelledError:
+        del INFLIGHT[key]
+        fut.cancel()
+        raise
     except Exception as e:
-        logger.exception("Ошибка Zenmux API (image+text->image)")
-        raise RuntimeError(f"Ошибка API: {e}")
+        del INFLIGHT[key]
+        fut.set_exception(e)
+        fut.exception()  # помечаем как прочитанное, даже если ждущих нет
+        raise
+    fut.set_result(png_bytes)
+    return png_bytes, False
+
+
+def _caption(text: str) -> str:
+    """Подпись к фото, обрезанная до лимита Telegram (1024 символа)."""
+    return _truncate(text, MessageLimit.CAPTION_LENGTH)
 
-    return _extract_image_from_response(response)
+
+async def download_photo(context: ContextTypes.DEFAULT_TYPE, file_id: str) -> bytes:
+    """Скачиваем фото из Telegram по file_id."""
+    file = await context.bot.get_file(file_id)
+    buf = BytesIO()
+    await file.download_to_memory(out=buf)
+    # getvalue() отдаёт внутренний буфер без копии, лишний bytes(...) не нужен
+    return buf.getvalue()
 
 
 # ----------------- TELEGRAM HANDLERS -----------------
 
 
+START_TEXT = (
+    "Привет! Я бот на Zenmux + Gemini 3 Pro 🖼\n\n"
+    "Я умею:\n"
+    "• генерировать картинки по тексту;\n"
+    "• делать вариации картинки по описанию.\n\n"
+    "1️⃣ Просто напиши текст — я нарисую картинку.\n"
+    "2️⃣ Пришли фото с подписью — сделаю вариацию по подписи.\n"
+    "3️⃣ Напиши: «отредактируй полученное изображение: …» — "
+    "я возьму последнюю картинку и сделаю новую версию."
+)
+
+HELP_TEXT = (
+    "Как пользоваться ботом:\n\n"
+    "📝 Текст → новая картинка\n"
+    "  «кот-бариста в стиле неонового киберпанка»\n\n"
+    "🖼 Фото + подпись → вариация картинки\n"
+    "  [фото] + «сделай поп-арт версию»\n\n"
+    "✏️ Редактирование последней картинки\n"
+    "  «отредактируй полученное изображение: сделай версию в стиле аниме»"
+)
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(
-        "Привет! Я бот на Zenmux + Gemini 3 Pro 🖼\n\n"
-        "Я умею:\n"
-        "• генерировать картинки по тексту;\n"
-        "• делать вариации картинки по описанию.\n\n"
-        "1️⃣ Просто напиши текст — я нарисую картинку.\n"
-        "2️⃣ Пришли фото с подписью — сделаю вариацию по подписи.\n"
-        "3️⃣ Напиши: «отредактируй полученное изображение: …» — "
-        "я возьму последнюю картинку и сделаю новую версию."
-    )
+    await update.message.reply_text(START_TEXT)
 
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(
-        "Как пользоваться ботом:\n\n"
-        "📝 Текст → новая картинка\n"
-        "  «кот-бариста в стиле неонового киберпанка»\n\n"
-        "🖼 Фото + подпись → вариация картинки\n"
-        "  [фото] + «сделай поп-арт версию»\n\n"
-        "✏️ Редактирование последней картинки\n"
-        "  «отредактируй полученное изображение: сделай версию в стиле аниме»"
-    )
+    await update.message.reply_text(HELP_TEXT)
 
 
 async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -163,19 +409,14 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     chat_id = update.effective_chat.id
     prompt = update.message.text.strip()
-    lower = prompt.lower()
 
-    has_last_image = chat_id in LAST_IMAGE_BY_CHAT
+    last_file_id = _lru_get(LAST_IMAGE_BY_CHAT, chat_id)
+    has_last_image = last_file_id is not None
 
-    is_edit_command = (
-        lower.startswith("отредактируй")
-        or lower.startswith("измени картинку")
-        or lower.startswith("сделай вариацию")
-    )
+    is_edit_command = EDIT_COMMAND_RE.match(prompt) is not None
 
     if is_edit_command and has_last_image:
-        base_image_bytes = LAST_IMAGE_BY_CHAT[chat_id]
-        await handle_generation(update, context, prompt, base_image_bytes)
+        await handle_generation(update, context, prompt, base_file_id=last_file_id)
     elif is_edit_command and not has_last_image:
         await update.message.reply_text(
             "Мне нечего редактировать — у меня пока нет сохранённого изображения.\n"
@@ -183,7 +424,7 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
     else:
         # обычная генерация с нуля
-        await handle_generation(update, context, prompt, base_image_bytes=None)
+        await handle_generation(update, context, prompt, base_file_id=None)
 
 
 async def photo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -196,13 +437,6 @@ async def photo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not message or not message.photo:
         return
 
-    chat_id = update.effective_chat.id
-
-    photo = message.photo[-1]
-    file = await context.bot.get_file(photo.file_id)
-    data = await file.download_to_memory()
-    image_bytes = bytes(data)
-
     caption = (message.caption or "").strip()
     if caption:
         prompt = caption
@@ -212,98 +446,232 @@ async def photo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "сохранив основную композицию."
         )
 
-    await handle_generation(update, context, prompt, base_image_bytes=image_bytes)
+    await handle_generation(
+        update, context, prompt, base_file_id=message.photo[-1].file_id
+    )
+
+
+async def show_upload_action(context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> None:
+    """Статус "отправляет фото…" в чате, пока идёт генерация (живёт ~5 с).
+
+    AIORateLimiter считает и эти вызовы в лимите группы (19 в минуту), поэтому
+    обновляем статус раз в UPLOAD_ACTION_INTERVAL, а не каждые 5 с.
+    """
+    while True:
+        try:
+            await context.bot.send_chat_action(
+                chat_id=chat_id, action=ChatAction.UPLOAD_PHOTO
+            )
+        except Exception as e:
+            logger.warning("Не удалось отправить chat action: %s", e)
+        await asyncio.sleep(UPLOAD_ACTION_INTERVAL)
+
+
+async def notify_if_queued(context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> None:
+    """Если все слоты GEN_SEM заняты, предупреждаем, что запрос ждёт в очереди."""
+    if not GEN_SEM.locked():
+        return
+    try:
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text="Сейчас много запросов — ты в очереди, картинка будет чуть позже ⏳",
+        )
+    except Exception as e:
+        logger.warning("Не удалось сообщить об очереди: %s", e)
 
 
 async def handle_generation(
     update: Update,
     context: ContextTypes.DEFAULT_TYPE,
     prompt: str,
-    base_image_bytes: Optional[bytes],
+    base_file_id: Optional[str],
 ):
-    """Общая логика генерации."""
+    """Общая логика генерации; base_file_id — исходное фото в Telegram, если есть."""
     chat_id = update.effective_chat.id
 
-    wait = await context.bot.send_message(
-        chat_id=chat_id,
-        text=(
-            "Генерирую картинку через Zenmux + Gemini 3 Pro…\n\n"
-            f"Запрос:\n`{prompt}`"
-        ),
-        parse_mode="Markdown",
-    )
-
-    try:
-        if base_image_bytes is None:
-            img_buf = generate_image_from_text(prompt)
-        else:
-            img_buf = generate_image_from_image(prompt, base_image_bytes)
-    except Exception as e:
-        logger.error("Ошибка генерации: %s", e)
-        await wait.edit_text(f"Не удалось сгенерировать картинку 😔\nОшибка: {e}")
-        return
-
-    # сохраняем последнюю картинку для этого чата
-    LAST_IMAGE_BY_CHAT[chat_id] = img_buf.getvalue()
-
-    # 1) отправляем пользователю
+    if base_file_id is None:
+        key = _prompt_cache_key(prompt)
+        file_id = _prompt_cache_get(key)
+        if file_id is not None:
+            # повтор из кэша — один send_photo по file_id, статус не нужен
+            try:
+                sent = await context.bot.send_photo(
+                    chat_id=chat_id,
+                    photo=file_id,
+                    caption=_caption(f"Картинка по запросу:\n{prompt}"),
+                )
+            except Exception as e:
+                # Telegram не принял сохранённый file_id — забываем его
+                # и генерируем картинку заново
+                logger.warning("Не удалось отправить картинку из кэша: %s", e)
+                PROMPT_CACHE.pop(key, None)
+            else:
+                file_id = sent.photo[-1].file_id
+                _lru_put(LAST_IMAGE_BY_CHAT, chat_id, file_id, LAST_IMAGE_CACHE_SIZE)
+                return
+
+    # вместо сообщения "Генерирую…" и его удаления — статус в шапке чата;
+    # включаем его, только когда запрос получил слот GEN_SEM, чтобы ожидание
+    # в очереди не съедало лимит группы
+    action: Optional[asyncio.Task] = None
+
+    def start_action() -> None:
+        nonlocal action
+        action = asyncio.create_task(show_upload_action(context, chat_id))
+
+    owns_inflight = False
+    is_new = False
     try:
-        img_buf.name = "generated.png"
-        img_buf.seek(0)
-
-        await context.bot.send_photo(
-            chat_id=chat_id,
-            photo=img_buf,
-            caption=f"Картинка по запросу:\n`{prompt}`",
-            parse_mode="Markdown",
-        )
         try:
-            await wait.delete()
-        except Exception:
-            pass
-    except Exception as e:
-        logger.exception("Ошибка отправки изображения пользователю")
-        await wait.edit_text(
-            f"Картинка сгенерирована, но не удалось отправить её в чат.\nОшибка: {e}"
-        )
-        return
+            if base_file_id is None:
+                png_bytes, joined = await generate_image_single_flight(
+                    key,
+                    prompt,
+                    lambda: notify_if_queued(context, chat_id),
+                    start_action,
+                )
+                owns_inflight = not joined
+            else:
+                # скачивание тоже может упасть — ошибку получит пользователь
+                base_image_bytes = await download_photo(context, base_file_id)
+                await notify_if_queued(context, chat_id)
+                # фото из Telegram бывают до 2560 px по большей стороне;
+                # пережатие в Pillow — CPU-работа, уводим её с event loop
+                image_bytes = await asyncio.to_thread(
+                    _downscale_image, base_image_bytes
+                )
+                png_bytes = await generate_image(prompt, image_bytes, start_action)
+        except Exception as e:
+            logger.error("Ошибка генерации: %s", e)
+            await context.bot.send_message(
+                chat_id=chat_id,
+                text=f"Не удалось сгенерировать картинку 😔\nОшибка: {e}",
+            )
+            return
 
-    # 2) копия владельцу без данных пользователя
-    if OWNER_CHAT_ID:
+        # 1) отправляем пользователю
         try:
-            owner_buf = BytesIO(LAST_IMAGE_BY_CHAT[chat_id])
-            owner_buf.seek(0)
-            owner_buf.name = "generated.png"
-
-            await context.bot.send_photo(
-                chat_id=OWNER_CHAT_ID,
-                photo=owner_buf,
-                caption=f"Новая сгенерированная картинка.\nПромпт:\n`{prompt}`",
-                parse_mode="Markdown",
+            sent = await context.bot.send_photo(
+                chat_id=chat_id,
+                photo=png_bytes,
+                filename="generated.png",
+                caption=_caption(f"Картинка по запросу:\n{prompt}"),
             )
         except Exception as e:
-            logger.exception("Ошибка отправки владельцу: %s", e)
+            logger.exception("Ошибка отправки изображения пользователю")
+            await context.bot.send_message(
+                chat_id=chat_id,
+                text=(
+                    "Картинка сгенерирована, но не удалось отправить её в чат.\n"
+                    f"Ошибка: {e}"
+                ),
+            )
+            return
+
+        file_id = sent.photo[-1].file_id
+
+        # запоминаем последнюю картинку для этого чата
+        _lru_put(LAST_IMAGE_BY_CHAT, chat_id, file_id, LAST_IMAGE_CACHE_SIZE)
+        # в кэш кладёт первый, кто успешно отправил свежую картинку: если
+        # ведущий не смог её отправить, это сделает один из присоединившихся
+        if base_file_id is None and _prompt_cache_get(key) is None:
+            _prompt_cache_put(key, file_id)
+            is_new = True
+    finally:
+        if action is not None:
+            action.cancel()
+        if owns_inflight:
+            # до этого момента одинаковые промпты брали готовые байты из INFLIGHT
+            del INFLIGHT[key]
+
+    # 2) копия владельцу — одна на каждую новую картинку
+    owner_chat_id = context.bot_data["cfg"].owner_chat_id
+    if owner_chat_id and (base_file_id is not None or is_new):
+        await forward_to_owner(context, owner_chat_id, file_id, prompt)
+
+
+async def forward_to_owner(
+    context: ContextTypes.DEFAULT_TYPE, owner_chat_id: str, file_id: str, prompt: str
+) -> None:
+    """Копия владельцу без данных пользователя — по file_id, без повторной загрузки."""
+    try:
+        await context.bot.send_photo(
+            chat_id=owner_chat_id,
+            photo=file_id,
+            caption=_caption(f"Новая сгенерированная картинка.\nПромпт:\n{prompt}"),
+        )
+    except Exception as e:
+        logger.exception("Ошибка отправки владельцу: %s", e)
 
 
 # ----------------- WEBHOOK (Render) -----------------
 
 
+class OrjsonRequest(HTTPXRequest):
+    """HTTPXRequest, который разбирает ответы Bot API через orjson."""
+
+    @staticmethod
+    def parse_json_payload(payload: bytes) -> dict:
+        try:
+            return orjson.loads(payload)
+        except orjson.JSONDecodeError as exc:
+            logger.error("Bot API вернул невалидный JSON: %r", payload[:512])
+            raise TelegramError("Invalid server response") from exc
+
+
 async def on_startup(app: Application):
-    logger.info("Bot is ready.")
+    loop = asyncio.get_running_loop()
+    logger.info("Bot is ready (event loop: %s).", type(loop).__module__)
 
+    # резолвим Zenmux сразу, чтобы ошибка DNS/конфига была видна при старте,
+    # а не на первом запросе пользователя
+    try:
+        infos = await loop.getaddrinfo(ZENMUX_HOST, 443, type=socket.SOCK_STREAM)
+    except OSError as e:
+        logger.error("Не удалось разрешить %s: %s", ZENMUX_HOST, e)
+    else:
+        addrs = sorted({info[4][0] for info in infos})
+        logger.info("%s -> %s", ZENMUX_HOST, ", ".join(addrs))
 
-def main():
-    token = os.getenv("TELEGRAM_TOKEN")
-    if not token:
-        raise RuntimeError("TELEGRAM_TOKEN не задан")
 
-    base_webhook_url = os.getenv("WEBHOOK_URL")
-    if not base_webhook_url:
-        raise RuntimeError("WEBHOOK_URL не задан (например, https://nanobot-92lp.onrender.com)")
+async def on_shutdown(app: Application):
+    """Закрываем пул соединений к Zenmux при остановке бота."""
+    if _genai_client is not None:
+        await _genai_client.aio.aclose()
+        _genai_client.close()
 
-    port = int(os.getenv("PORT", "8443"))
 
-    application = Application.builder().token(token).build()
+def main():
+    cfg = load_config()
+    init_genai_client(cfg.zenmux_api_key)
+
+    # run_webhook создаёт свой event loop — ставим политику uvloop до него
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    # лимиты Bot API: ~30 сообщений/с на бота и ~20/мин на группу;
+    # при RetryAfter лимитер сам ждёт retry_after и повторяет запрос
+    rate_limiter = AIORateLimiter(
+        overall_max_rate=29,
+        overall_time_period=1,
+        group_max_rate=19,
+        group_time_period=60,
+        max_retries=3,
+    )
+
+    application = (
+        Application.builder()
+        .token(cfg.telegram_token)
+        # размер пула как у стандартного запроса ApplicationBuilder
+        .request(OrjsonRequest(connection_pool_size=256))
+        .rate_limiter(rate_limiter)
+        # по умолчанию PTB обрабатывает апдейты строго по одному — тогда
+        # генерация одного пользователя держит всех остальных; столько же,
+        # сколько webhook-соединений (max_connections ниже)
+        .concurrent_updates(100)
+        .build()
+    )
+    application.bot_data["cfg"] = cfg
 
     # handlers
     application.add_handler(CommandHandler("start", start))
@@ -312,19 +680,29 @@ def main():
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_handler))
 
     application.post_init = on_startup
+    application.post_shutdown = on_shutdown
 
-    webhook_path = f"/webhook/{token}"
-    webhook_url = base_webhook_url.rstrip("/") + webhook_path
+    webhook_path = f"/webhook/{cfg.telegram_token}"
+    webhook_url = cfg.webhook_url.rstrip("/") + webhook_path
 
-    logger.info("Запуск webhook-сервера на порту %s, webhook_url=%s", port, webhook_url)
-
-    application.run_webhook(
-        listen="0.0.0.0",
-        port=port,
-        url_path=webhook_path,
-        webhook_url=webhook_url,
+    logger.info(
+        "Запуск webhook-сервера на порту %s, webhook_url=%s", cfg.port, webhook_url
     )
 
+    log_listener = start_queue_logging()
+    try:
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=cfg.port,
+            url_path=webhook_path,
+            webhook_url=webhook_url,
+            # бот обрабатывает только сообщения — остальные типы апдейтов не нужны
+            allowed_updates=[Update.MESSAGE],
+            max_connections=100,
+        )
+    finally:
+        log_listener.stop()  # дописывает оставшиеся в очереди записи
+
 
 if __name__ == "__main__":
     main()